@@ -1,3 +1,6 @@
 #  -*- coding: utf8 -*-
 from amed_tools.functions import *
+from amed_tools.key_tools import *
 from amed_tools.db_tools import *
+from amed_tools.xlsm_tools import *
+from amed_tools.file_tools import *
@@ -3,8 +3,12 @@
 """Functions used within amed_tools."""
 
 # Import required modules
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import heapq
+import pathlib
 import sqlite3
-from amed_tools.functions import *
+from amed_tools.key_tools import *
 
 __author__ = 'Victoria Morris'
 __license__ = 'MIT License'
@@ -12,17 +16,188 @@ __version__ = '1.0.0'
 __status__ = '4 - Beta Development'
 
 
+# ====================
+#      Constants
+# ====================
+
+
+# Publication year within a citation or citation key, e.g. 'J Adv Nurs 2023;79(12):4489-4505'
+# or 'J ADV NURS 2023 79 12 4489 4505'
+RE_CITATION_YEAR = re.compile(r'\b((?:1[89]|20)[0-9]{2})\b')
+
+# Number of citations read and updated at a time when regenerating citation keys
+REKEY_BATCH_SIZE = 10000
+
+# Number of ranges of ids per worker into which each database is divided when scanning citations
+RANGES_PER_WORKER = 4
+
+# Number of seconds to wait for another run to finish reserving accession numbers
+ACCESSION_TIMEOUT = 60
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def citation_partition(citation: str, years: int) -> str:
+    """Function to return the name of the partition holding a citation.
+
+    Citations are partitioned by publication year, in spans of the given number of years;
+    e.g. with years = 10, citations published from 2010 to 2019 are held in partition 2010.
+    """
+    year = RE_CITATION_YEAR.search(citation or '')
+    if not year:
+        return 'other'
+    year = int(year.group(1))
+    return str(year - year % years)
+
+
+def partition_paths(database_path) -> dict:
+    """Function to return the paths of the existing partitions of a citation database, by partition name"""
+    prefix = os.path.splitext(database_path)[0] + '_'
+    paths = {}
+    for partition_path in sorted(glob.glob(glob.escape(prefix) + '*.db')):
+        partition = partition_path[len(prefix):-len('.db')]
+        if partition.isdigit() or partition == 'other':
+            paths[partition] = partition_path
+    return paths
+
+
+def check_partitions(database_path, years):
+    """Function to raise an error if a citation database has been partitioned but no span of years is given,
+    as duplicates would otherwise only be looked for in the main database, which holds no citations"""
+    if years <= 0 and partition_paths(database_path):
+        raise AMEDError(f'Error: The citation database {str(database_path)} has been partitioned, '
+                        f'so PARTITION_CITATIONS must be given')
+
+
+def open_citation_database(database_path, years=0):
+    """Function to open a citation database, partitioned in spans of the given number of years if years > 0"""
+    check_partitions(database_path, years)
+    if years > 0:
+        return PartitionedCitationDatabase(database_path, years)
+    return CitationDatabase(database_path)
+
+
+def list_path(database_path) -> str:
+    """Function to return the path of the list of citations exported from a citation database,
+    e.g. amed_citations_list.txt"""
+    return os.path.splitext(database_path)[0] + '_list.txt'
+
+
+def accession_path(database_path) -> str:
+    """Function to return the path of the database of accession numbers kept alongside a citation database,
+    e.g. amed_citations_accessions.db"""
+    return os.path.splitext(database_path)[0] + '_accessions.db'
+
+
+def read_only_connection(database_path):
+    """Function to open a read-only database connection; any number of these may be open at once"""
+    return sqlite3.connect(pathlib.Path(database_path).resolve().as_uri() + '?mode=ro', uri=True,
+                           check_same_thread=False)
+
+
+def id_ranges(database_path, count) -> list:
+    """Function to divide the ids of the citations in a database into at most count contiguous ranges"""
+    conn = read_only_connection(database_path)
+    low, high = conn.execute('SELECT MIN(id), MAX(id) FROM citations ;').fetchone()
+    conn.close()
+    if low is None:
+        return []
+    size = max(1, -(-(high - low + 1) // count))
+    return [(start, min(start + size - 1, high)) for start in range(low, high + 1, size)]
+
+
+def check_integrity(database_path) -> list:
+    """Function to check the integrity of a database file, returning a list of any problems found"""
+    conn = read_only_connection(database_path)
+    results = [str(r[0]) for r in conn.execute('PRAGMA integrity_check ;')]
+    conn.close()
+    return [] if results == ['ok'] else results
+
+
+def scan_citations(database_path, low, high, partition=None, years=0) -> dict:
+    """Function to scan the citations with ids from low to high, using a read-only connection.
+
+    Returns the number of citations, the number in each publication year,
+    lists of ids of empty citations, of keys which are not normalised and of keys in the wrong partition,
+    and the keys grouped by normalise_key().
+    """
+    conn = read_only_connection(database_path)
+    results = {'count': 0, 'years': Counter(), 'empty': [], 'not_normalised': [], 'wrong_partition': [],
+               'normalised': {}}
+    for citation_id, citation in conn.execute(
+            'SELECT id, citation FROM citations WHERE id BETWEEN ? AND ? ORDER BY id ASC ;', (low, high)):
+        results['count'] += 1
+        if not citation:
+            results['empty'].append(citation_id)
+            continue
+        key = normalise_key(citation)
+        if key != citation:
+            results['not_normalised'].append(citation)
+        if partition is not None and citation_partition(citation, years) != partition:
+            results['wrong_partition'].append(citation)
+        year = RE_CITATION_YEAR.search(citation)
+        results['years'][year.group(1) if year else 'unknown'] += 1
+        results['normalised'].setdefault(key, []).append(citation)
+    conn.close()
+    return results
+
+
+def check_databases(database_path, years=0, workers=None) -> dict:
+    """Function to check the integrity of a citation database and its partitions in parallel"""
+    paths = [database_path] + (list(partition_paths(database_path).values()) if years > 0 else [])
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(paths, executor.map(check_integrity, paths)))
+
+
+def scan_databases(database_path, years=0, workers=None) -> dict:
+    """Function to scan a citation database and its partitions in parallel, over ranges of ids.
+
+    Ranges are scanned in separate processes, since scanning is mostly Python code,
+    which threads cannot run in parallel.
+    Returns the combined results of scan_citations(), with the groups of near-identical keys,
+    i.e. keys which have the same normalised form, in place of the keys grouped by normalise_key().
+    """
+    workers = workers or os.cpu_count() or 1
+    # Any citations in the main database of a partitioned database are in the wrong partition
+    paths = {'main' if years > 0 else None: database_path}
+    if years > 0:
+        paths.update(partition_paths(database_path))
+    units = [(paths[partition], low, high, partition, years) for partition in paths
+             for low, high in id_ranges(paths[partition], workers * RANGES_PER_WORKER)]
+    results = [None] * len(units)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(scan_citations, *unit): i for i, unit in enumerate(units)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            print(f'{str(done)} of {str(len(units))} ranges scanned', end='\r')
+    totals = {'count': 0, 'years': Counter(), 'empty': [], 'not_normalised': [], 'wrong_partition': [],
+              'normalised': {}}
+    for result in results:
+        for k in ['count', 'years', 'empty', 'not_normalised', 'wrong_partition']:
+            totals[k] += result[k]
+        for k in result['normalised']:
+            totals['normalised'].setdefault(k, []).extend(result['normalised'][k])
+    totals['near_duplicates'] = [sorted(keys) for keys in totals.pop('normalised').values() if len(keys) > 1]
+    collect()
+    return totals
+
+
 # ====================
 #       Classes
 # ====================
 
 class CitationDatabase:
 
-    def __init__(self, database_path):
+    def __init__(self, database_path, quiet=False):
         """Open a new database connection, and ensure that the correct tables are present"""
-        date_time_message('Connecting to local database')
+        self.quiet = quiet
+        self.message('Connecting to local database')
         self.path = database_path
-        self.conn = sqlite3.connect(database_path)
+        # A partition may be maintained from a worker thread, though never from more than one thread at once
+        self.conn = sqlite3.connect(database_path, check_same_thread=False)
         self.cursor = self.conn.cursor()
 
         # Set up database
@@ -32,6 +207,14 @@ class CitationDatabase:
         self.cursor.execute('PRAGMA count_changes = FALSE')
 
         self.cursor.execute('CREATE TABLE IF NOT EXISTS citations (id INTEGER PRIMARY KEY, citation TEXT UNIQUE);')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);')
+        if self.get_key_version() is None:
+            # Databases created before key versions were recorded contain version 1 keys
+            self.set_key_version(KEY_VERSION if self.is_empty() else 1)
+
+    def message(self, message):
+        if not self.quiet:
+            date_time_message(message)
 
     def close(self):
         """Close the database connection"""
@@ -40,15 +223,17 @@ class CitationDatabase:
 
     def clean(self, quick_clean=False):
         """Clean the database to remove unnecessary values"""
-        date_time_message('Cleaning')
+        self.message('Cleaning')
         self.cursor.execute('DELETE FROM citations WHERE citation IS NULL OR citation = "" ;')
+        # VACUUM cannot be run within a transaction
+        self.conn.commit()
         self.conn.execute("VACUUM")
         self.conn.commit()
         collect()
 
     def build_index(self):
         """Function to build indexes in a table"""
-        date_time_message('Building indexes in citations table')
+        self.message('Building indexes in citations table')
         self.cursor.execute('DROP INDEX IF EXISTS IDX_citations ;')
         self.cursor.execute('CREATE INDEX IDX_citations ON citations (citation);')
         self.conn.commit()
@@ -61,8 +246,72 @@ class CitationDatabase:
             collect()
         return []
 
+    def get_metadata(self, name):
+        self.cursor.execute('SELECT value FROM metadata WHERE name = ? ;', (name,))
+        result = self.cursor.fetchone()
+        return result[0] if result else None
+
+    def set_metadata(self, name, value):
+        self.cursor.execute('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?) ;', (name, str(value)))
+        self.conn.commit()
+
+    def get_key_version(self):
+        """Function to return the version of the rules used to generate the citation keys in the database"""
+        version = self.get_metadata('key_version')
+        return int(version) if version else None
+
+    def set_key_version(self, version):
+        self.set_metadata('key_version', version)
+
+    def is_empty(self) -> bool:
+        self.cursor.execute('SELECT 1 FROM citations LIMIT 1 ;')
+        return self.cursor.fetchone() is None
+
+    def rekey(self, batch_size=REKEY_BATCH_SIZE, keep=None) -> list:
+        """Regenerate all citation keys using the current rules, reading and updating the table in batches.
+
+        Keys which become identical are merged. Keys for which keep(key) is False are removed and returned.
+        """
+        self.message('Regenerating citation keys')
+        removed, last_id, count = [], 0, 0
+        while True:
+            self.cursor.execute('SELECT id, citation FROM citations WHERE id > ? ORDER BY id ASC LIMIT ? ;',
+                                (last_id, batch_size))
+            rows = self.cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates, deletes = [], []
+            for citation_id, citation in rows:
+                if citation is None:
+                    continue
+                key = normalise_key(citation)
+                if keep is not None and not keep(key):
+                    deletes.append((citation_id,))
+                    removed.append(key)
+                elif key != citation:
+                    updates.append((key, citation_id))
+            self.cursor.executemany('UPDATE OR REPLACE citations SET citation = ? WHERE id = ? ;', updates)
+            self.cursor.executemany('DELETE FROM citations WHERE id = ? ;', deletes)
+            self.conn.commit()
+            count += len(updates) + len(deletes)
+        self.set_key_version(KEY_VERSION)
+        self.message('{} citation keys changed'.format(str(count)))
+        collect()
+        return removed
+
+    def has_citation(self, citation) -> bool:
+        self.cursor.execute('SELECT 1 FROM citations WHERE citation = ? LIMIT 1 ;', (citation,))
+        return self.cursor.fetchone() is not None
+
+    def remove_citations(self, citations):
+        if citations is None or len(citations) == 0: return None
+        self.execute_all('DELETE FROM citations WHERE citation = ? ;', citations)
+        self.message('{} citations removed'.format(str(len(citations))))
+        return len(citations)
+
     def get_citations(self):
-        date_time_message('Reading list of citations from database')
+        self.message('Reading list of citations from database')
         self.cursor.execute('SELECT citation FROM citations WHERE citation IS NOT NULL ORDER BY citation ASC ;')
         try: results = list(s[0] for s in self.cursor.fetchall())
         except:
@@ -70,21 +319,261 @@ class CitationDatabase:
             return None
         return results
 
-    def add_citations(self, citations):
-        if citations is None or len(citations) == 0: return None
+    def insert_citations(self, citations):
+        """Insert citations, without re-indexing or exporting"""
         sql_query = 'INSERT OR IGNORE INTO citations (id, citation) VALUES (NULL, ?) ;'
         self.execute_all(sql_query, citations)
-        date_time_message('{} citations added'.format(str(len(citations))))
+
+    def add_citations(self, citations):
+        if citations is None or len(citations) == 0: return None
+        self.insert_citations(citations)
+        self.message('{} citations added'.format(str(len(citations))))
         self.build_index()
         self.export()
         return len(citations)
 
     def export(self):
-        date_time_message('Exporting citations from database')
+        self.message('Exporting citations from database')
         citations = self.get_citations()
         if not citations or len(citations) == 0: return
-        file = open(self.path.replace('.db','_list.txt'), mode='w', encoding='utf-8', errors='replace')
+        file = open(list_path(self.path), mode='w', encoding='utf-8', errors='replace')
         for c in sorted(citations):
             file.write('{}\n'.format(str(c)))
         file.close()
         collect()
+
+
+class PartitionedCitationDatabase:
+    """Class for a citation database in which citations are partitioned by publication year.
+
+    Each partition is held in a separate database alongside the main database,
+    e.g. amed_citations_2010.db, so that partitions can be maintained independently and in parallel.
+    Citations in the main database are moved into partitions when it is opened.
+    The span of years is recorded in the main database; if it has changed, the citations are re-partitioned.
+    """
+
+    def __init__(self, database_path, years=10):
+        date_time_message('Connecting to local database')
+        self.path = database_path
+        self.years = years
+        self.main = CitationDatabase(database_path, quiet=True)
+        self.partitions = {}
+        self.changed = set()
+        for partition in partition_paths(database_path):
+            self.get_partition(partition)
+        span = self.main.get_metadata('partition_years')
+        if self.partitions and span != str(years):
+            # Partitions made before the span was recorded are also re-partitioned, as their span is not known
+            date_time_message(f'Re-partitioning citations in spans of {str(years)} years')
+            self.rekey()
+            self.build_index()
+            self.export()
+        self.main.set_metadata('partition_years', years)
+        self.partition()
+
+    def get_partition(self, partition) -> CitationDatabase:
+        if partition not in self.partitions:
+            partition_path = os.path.splitext(self.path)[0] + f'_{partition}.db'
+            self.partitions[partition] = CitationDatabase(partition_path, quiet=True)
+        return self.partitions[partition]
+
+    def partition(self):
+        """Move any citations in the main database into the appropriate partitions"""
+        citations = self.main.get_citations()
+        if not citations:
+            return
+        date_time_message('Partitioning citations')
+        self.insert_citations([(c,) for c in citations])
+        # Partitions hold keys of the same version as the main database they were moved from
+        version = self.main.get_key_version()
+        for partition in self.changed:
+            if self.partitions[partition].get_key_version() > version:
+                self.partitions[partition].set_key_version(version)
+        self.build_index()
+        self.export()
+        self.main.cursor.execute('DELETE FROM citations ;')
+        self.main.conn.commit()
+        self.main.clean()
+
+    def maintain(self, function, partitions=None):
+        """Run a maintenance function on the given partitions (by default, those that have changed) in parallel"""
+        partitions = self.changed if partitions is None else partitions
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(lambda p: function(self.partitions[p]), sorted(partitions)))
+
+    def close(self):
+        """Close all database connections"""
+        self.main.close()
+        for partition in self.partitions:
+            self.partitions[partition].close()
+        collect()
+
+    def clean(self, quick_clean=False, partitions=None):
+        """Clean the partitions to remove unnecessary values"""
+        date_time_message('Cleaning')
+        self.maintain(lambda db: db.clean(quick_clean), partitions)
+
+    def build_index(self, partitions=None):
+        date_time_message('Building indexes in citations tables')
+        self.maintain(lambda db: db.build_index(), partitions)
+
+    def get_key_version(self):
+        return min(db.get_key_version() for db in [self.main] + list(self.partitions.values()))
+
+    def rekey(self, batch_size=REKEY_BATCH_SIZE):
+        """Regenerate all citation keys using the current rules, moving any which are not in the correct partition.
+
+        Partitions left empty are removed.
+        """
+        date_time_message('Regenerating citation keys')
+        moved = []
+        with ThreadPoolExecutor() as executor:
+            for removed in executor.map(lambda p: self.partitions[p].rekey(
+                    batch_size, keep=lambda key: citation_partition(key, self.years) == p), sorted(self.partitions)):
+                moved.extend(removed)
+        self.changed.update(self.partitions)
+        self.insert_citations([(c,) for c in moved])
+        self.remove_empty_partitions()
+        self.main.set_key_version(KEY_VERSION)
+
+    def remove_empty_partitions(self):
+        """Remove partitions which hold no citations, together with their exported lists"""
+        for partition in sorted(self.partitions):
+            db = self.partitions[partition]
+            if db.is_empty():
+                db.close()
+                for path in [db.path, list_path(db.path)]:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                del self.partitions[partition]
+                self.changed.discard(partition)
+
+    def has_citation(self, citation) -> bool:
+        partition = citation_partition(citation, self.years)
+        return partition in self.partitions and self.partitions[partition].has_citation(citation)
+
+    def get_citations(self):
+        date_time_message('Reading list of citations from database')
+        results = []
+        for partition in sorted(self.partitions):
+            results.extend(self.partitions[partition].get_citations() or [])
+        return sorted(results)
+
+    def insert_citations(self, citations):
+        """Insert citations into the appropriate partitions, without re-indexing or exporting"""
+        sql_query = 'INSERT OR IGNORE INTO citations (id, citation) VALUES (NULL, ?) ;'
+        grouped = {}
+        for c in citations:
+            grouped.setdefault(citation_partition(c[0], self.years), []).append(c)
+        for partition in grouped:
+            self.get_partition(partition).execute_all(sql_query, grouped[partition])
+            self.changed.add(partition)
+
+    def remove_citations(self, citations):
+        if citations is None or len(citations) == 0: return None
+        grouped = {}
+        for c in citations:
+            grouped.setdefault(citation_partition(c[0], self.years), []).append(c)
+        for partition in grouped:
+            if partition in self.partitions:
+                self.partitions[partition].execute_all('DELETE FROM citations WHERE citation = ? ;', grouped[partition])
+                self.changed.add(partition)
+        date_time_message('{} citations removed'.format(str(len(citations))))
+        return len(citations)
+
+    def add_citations(self, citations):
+        if citations is None or len(citations) == 0: return None
+        self.insert_citations(citations)
+        date_time_message('{} citations added'.format(str(len(citations))))
+        self.build_index()
+        self.export()
+        return len(citations)
+
+    def export(self, partitions=None):
+        """Export citations from each partition to a separate list, e.g. amed_citations_2010_list.txt,
+        then merge the lists of all partitions into a single list, e.g. amed_citations_list.txt"""
+        date_time_message('Exporting citations from database')
+        self.maintain(lambda db: db.export(), partitions)
+        paths = [list_path(self.partitions[p].path) for p in sorted(self.partitions)]
+        lists = [open(path, mode='r', encoding='utf-8', errors='replace') for path in paths if os.path.isfile(path)]
+        file = open(list_path(self.path), mode='w', encoding='utf-8', errors='replace')
+        # Each list is already sorted, so the merged list is sorted in the same order as an unpartitioned list
+        for line in heapq.merge(*lists):
+            file.write(line)
+        file.close()
+        for f in lists:
+            f.close()
+        collect()
+
+
+class AccessionAllocator:
+    """Class for reserving blocks of accession numbers, recorded in a database alongside the citation database.
+
+    The citation database is locked for the whole of a run, so the blocks are kept in a separate database.
+    Each operation uses its own short-lived connection, so runs sharing the database wait for one another
+    rather than failing, and no lock is held while records are processed.
+    """
+
+    def __init__(self, database_path):
+        self.path = accession_path(database_path)
+        # Blocks of accession numbers reserved by each run; used is NULL until the run is complete
+        self.transaction(lambda conn: conn.execute('CREATE TABLE IF NOT EXISTS accession_numbers '
+                                                   '(start INTEGER PRIMARY KEY, reserved INTEGER, used INTEGER, '
+                                                   'date TEXT);'))
+
+    def transaction(self, function):
+        """Function to call function(conn) within a single transaction on a new connection, returning the result"""
+        conn = sqlite3.connect(self.path, timeout=ACCESSION_TIMEOUT, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = function(conn)
+            conn.execute('COMMIT')
+            return result
+        except:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def next_number(conn):
+        return conn.execute('SELECT MAX(start + COALESCE(used, reserved)) FROM accession_numbers ;').fetchone()[0]
+
+    def next_accession_number(self):
+        """Function to return the first accession number after all those reserved, or None if there are none"""
+        return self.transaction(self.next_number)
+
+    def reserve_accession_numbers(self, count, start=None) -> int:
+        """Reserve a block of count accession numbers, and return the first number in the block.
+
+        The block begins at start if given, or otherwise immediately after all the blocks already reserved.
+        """
+        def reserve(conn):
+            first = self.next_number(conn) if start is None else start
+            if first is None:
+                raise AMEDError('Error: No accession numbers have been reserved, so the first must be given')
+            if conn.execute('SELECT start FROM accession_numbers '
+                            'WHERE start < ? AND start + COALESCE(used, reserved) > ? LIMIT 1 ;',
+                            (first + count, first)).fetchone():
+                raise AMEDError(f'Error: Accession numbers from {str(first)} to {str(first + count - 1)} '
+                                f'overlap those already reserved')
+            conn.execute('INSERT INTO accession_numbers (start, reserved, used, date) VALUES (?, ?, NULL, ?) ;',
+                         (first, count, datetime.datetime.now().isoformat(timespec='seconds')))
+            return first
+
+        first = self.transaction(reserve)
+        date_time_message('Accession numbers {} to {} reserved'.format(str(first), str(first + count - 1)))
+        return first
+
+    def record_accession_numbers(self, start, used):
+        """Record the number of accession numbers actually used from the block beginning at start.
+
+        Any numbers in the block which were not used are released, unless a later block has already been reserved;
+        recording 0 removes the whole block, e.g. if processing has failed, so that it can be reserved again.
+        """
+        if used == 0:
+            self.transaction(lambda conn: conn.execute('DELETE FROM accession_numbers WHERE start = ? ;', (start,)))
+        else:
+            self.transaction(lambda conn: conn.execute('UPDATE accession_numbers SET used = ? WHERE start = ? ;',
+                                                       (used, start)))
@@ -0,0 +1,138 @@
+#  -*- coding: utf8 -*-
+
+"""Functions for writing AMED output files."""
+
+# Import required modules
+import gzip
+import hashlib
+import io
+import queue
+import threading
+from amed_tools.functions import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class ChecksumWriter(io.RawIOBase):
+    """Class for writing bytes to a file while calculating their SHA-256 checksum"""
+
+    def __init__(self, file):
+        super().__init__()
+        self.file = file
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        return self.file.write(b)
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.file.close()
+
+
+class DeliveryFile(io.TextIOWrapper):
+    """Class for writing a delivery file with CRLF line endings, optionally compressed with gzip.
+
+    The SHA-256 checksum of the file written to disk is calculated as it is written,
+    so the file does not need to be read again once it is complete.
+    """
+
+    def __init__(self, path, compress=False):
+        self.path = path + '.gz' if compress else path
+        self.checksum = ChecksumWriter(open(self.path, mode='wb'))
+        if compress:
+            binary = gzip.GzipFile(filename=os.path.basename(path), mode='wb', fileobj=self.checksum)
+        else:
+            binary = io.BufferedWriter(self.checksum)
+        super().__init__(binary, encoding='utf-8', errors='replace', newline='\r\n')
+
+    def close(self):
+        # GzipFile does not close a file object passed to it
+        super().close()
+        self.checksum.close()
+
+    def sha256(self) -> str:
+        return self.checksum.sha256.hexdigest()
+
+
+class BackgroundWriter:
+    """Class for writing to a file from a background thread, so that processing does not wait for the disk.
+
+    Text written is collected into chunks of at least chunk_size characters, which are passed to the
+    background thread through a queue holding at most max_chunks chunks. The wrapped file encodes
+    and writes each chunk in the background thread, so write() only blocks if the queue is full.
+
+    The writer should be closed even if processing fails, e.g. by using it in a with statement,
+    as text still in the queue is lost if the program exits while the background thread is running.
+    """
+
+    def __init__(self, file, chunk_size=1 << 20, max_chunks=8):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.chunk, self.chunk_length = [], 0
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            # After an error, continue to empty the queue so that write() cannot block indefinitely
+            if self.error is None:
+                try:
+                    self.file.write(chunk)
+                except Exception as e:
+                    self.error = e
+
+    def check(self):
+        """Function to raise any error that has occurred in the background thread"""
+        if self.error is not None:
+            raise AMEDError(f'Error: Could not write to {str(getattr(self.file, "name", self.file))}: '
+                            f'{str(self.error)}')
+
+    def write(self, s):
+        self.check()
+        self.chunk.append(s)
+        self.chunk_length += len(s)
+        if self.chunk_length >= self.chunk_size:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        """Pass the text collected so far to the background thread, without waiting for it to be written"""
+        if self.chunk:
+            self.queue.put(self.chunk[0][:0].join(self.chunk))
+            self.chunk, self.chunk_length = [], 0
+
+    def close(self):
+        """Wait for all text to be written, then close the file"""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.check()
@@ -33,6 +33,20 @@ ARGS = {
                                             nargs=1, help='path to output file'),
     'c': lambda parser: parser.add_argument('-c', metavar='<config_file>', required=True, action='store', type=str,
                                             nargs=1, help='path to config file'),
+    'gzip': lambda parser: parser.add_argument('--gzip', required=False, action='store_true',
+                                               help='compress output files with gzip'),
+    'check': lambda parser: parser.add_argument('--check', required=False, action='store_true',
+                                                help='check the integrity of the citation database'),
+    'stats': lambda parser: parser.add_argument('--stats', required=False, action='store_true',
+                                                help='report statistics for the citation database'),
+    'dedupe': lambda parser: parser.add_argument('--dedupe', required=False, action='store_true',
+                                                 help='merge near-identical citation keys'),
+    'repartition': lambda parser: parser.add_argument('--repartition', required=False, action='store_true',
+                                                      help='move citations into the correct partitions'),
+    'export': lambda parser: parser.add_argument('--export', required=False, action='store_true',
+                                                 help='export the list of citations'),
+    'workers': lambda parser: parser.add_argument('--workers', metavar='<workers>', required=False, action='store',
+                                                  type=int, default=None, help='number of workers'),
 }
 
 OPTS = OrderedDict([
@@ -0,0 +1,71 @@
+#  -*- coding: utf8 -*-
+
+"""Functions for formatting citations and generating the citation keys used to detect duplicates."""
+
+# Import required modules
+from amed_tools.functions import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+# Version of the rules used to generate citation keys; this is stored in the citation database.
+# Increase this whenever normalise_key() is changed, so that existing keys are regenerated.
+# Version 1: citation followed by up to 20 characters from the title
+# Version 2: as version 1, with whitespace normalised
+# Version 3: as version 1, in upper case, with each run of spaces and punctuation replaced by a single space,
+# so that keys which differ only in case, spacing or punctuation are the same
+KEY_VERSION = 3
+
+# Number of characters from the title appended to the citation
+KEY_TITLE_LENGTH = 20
+
+RE_ISSUE_SUPPLEMENT = re.compile(r'\s*SUPP/([0-9]+)')
+RE_ISSUE_SUPPLEMENT_S = re.compile(r'\s*\(S/\s*([0-9]+)\)')
+RE_ISSUE_VOLUME_NUMBER = re.compile(r'\s*VOL\s*([^\s]*?);\s*NUMBER\s*(.*)$')
+RE_ISSUE_VOLUME = re.compile(r'\s*VOL\s*')
+RE_PAGES_SINGLE = re.compile(r'^([^\-]+)-\1$')
+RE_KEY_TITLE = re.compile(r'[^A-Z0-9]')
+# Separators are kept, so that e.g. volume 12, issue 3 and volume 1, issue 23 remain different
+RE_KEY_SEPARATOR = re.compile(r'[\W_]+')
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def format_issue(issue: str) -> str:
+    """Function to format the content of the ETOC field ISSUE, e.g. '2024; VOL 80; NUMBER 2' as '2024;80(2)'"""
+    issue = RE_ISSUE_SUPPLEMENT_S.sub(r'(Suppl \1)', RE_ISSUE_SUPPLEMENT.sub(r'(Suppl \1)', issue))
+    return RE_ISSUE_VOLUME.sub('', RE_ISSUE_VOLUME_NUMBER.sub(r'\1(\2)', clean(issue)))
+
+
+def format_pages(pages: str) -> str:
+    """Function to format the content of the ETOC field PAGE, e.g. '12-12' as '12'"""
+    return RE_PAGES_SINGLE.sub(r'\1', clean(pages))
+
+
+def format_citation(journal_title: str, issue: str, pages: str) -> str:
+    return journal_title + ' ' + issue + ':' + pages
+
+
+def normalise_key(key: str) -> str:
+    """Function to apply the current rules for normalising a citation key.
+
+    This is applied both to new keys and to keys already in the citation database when they are regenerated,
+    so must give the same result when applied to a key that has already been normalised.
+    """
+    return RE_KEY_SEPARATOR.sub(' ', key.upper()).strip()
+
+
+def citation_key(citation: str, title: str) -> str:
+    """Function to return the key used to detect duplicate records"""
+    return normalise_key(citation + RE_KEY_TITLE.sub('', title.upper())[:KEY_TITLE_LENGTH])
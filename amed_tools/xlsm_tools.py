@@ -0,0 +1,206 @@
+#  -*- coding: utf8 -*-
+
+"""Functions for reading AMED records directly from the AMED processing.xlsm workbook."""
+
+# Import required modules
+import posixpath
+import xml.etree.ElementTree as ET
+import zipfile
+from amed_tools.functions import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '1.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Constants
+# ====================
+
+
+WORKBOOK_EXTENSIONS = ('.xlsm', '.xlsx')
+WORKBOOK_SHEET = 'AMED records'
+# Column A of the AMED records sheet is used to display the selected record;
+# the exported data begins in column B
+WORKBOOK_FIRST_COLUMN = 'B'
+
+NS_MAIN = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+NS_REL = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+NS_PACKAGE_REL = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+RE_CELL_REFERENCE = re.compile(r'^([A-Z]+)([0-9]*)$')
+# Number format which displays integers with leading zeros, e.g. 0000000 for accession numbers
+RE_ZERO_PADDED_FORMAT = re.compile(r'^(0+)(;|$)')
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def is_workbook(path: str) -> bool:
+    return path.lower().endswith(WORKBOOK_EXTENSIONS)
+
+
+def column_index(column: str) -> int:
+    """Function to convert a column reference such as 'B' or 'AA' to a zero-based index"""
+    index = 0
+    for c in column.upper():
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index - 1
+
+
+def text_content(element) -> str:
+    """Function to return the text of a shared or inline string, ignoring phonetic runs"""
+    s = ''
+    for child in element:
+        if child.tag == NS_MAIN + 't':
+            s += child.text or ''
+        elif child.tag == NS_MAIN + 'r':
+            s += child.findtext(NS_MAIN + 't') or ''
+    return s
+
+
+# ====================
+#       Classes
+# ====================
+
+
+class WorkbookReader:
+    """Class for streaming rows from a sheet of an Excel workbook without building a DOM for the whole sheet"""
+
+    def __init__(self, path, sheet_name=WORKBOOK_SHEET, first_column=WORKBOOK_FIRST_COLUMN):
+        if not os.path.isfile(path):
+            raise AMEDError(f'Error: Could not locate workbook at {str(path)}')
+        try:
+            self.zip = zipfile.ZipFile(path, mode='r')
+        except zipfile.BadZipFile:
+            raise AMEDError(f'Error: {str(path)} is not a valid Excel workbook')
+        self.path = path
+        self.sheet_name = sheet_name
+        self.first_column = column_index(first_column)
+        self.sheet_path = self.get_sheet_path()
+        self.shared_strings = self.get_shared_strings()
+        self.number_formats = self.get_number_formats()
+
+    def close(self):
+        self.zip.close()
+        collect()
+
+    def get_sheet_path(self) -> str:
+        """Function to find the location of the named sheet within the workbook package"""
+        workbook = ET.fromstring(self.zip.read('xl/workbook.xml'))
+        relationship_id = None
+        for sheet in workbook.iter(NS_MAIN + 'sheet'):
+            if sheet.get('name') == self.sheet_name:
+                relationship_id = sheet.get(NS_REL + 'id')
+                break
+        if relationship_id is None:
+            raise AMEDError(f'Error: Could not locate sheet {self.sheet_name} in {str(self.path)}')
+        relationships = ET.fromstring(self.zip.read('xl/_rels/workbook.xml.rels'))
+        for relationship in relationships.iter(NS_PACKAGE_REL + 'Relationship'):
+            if relationship.get('Id') == relationship_id:
+                target = relationship.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/')
+                return posixpath.normpath(posixpath.join('xl', target))
+        raise AMEDError(f'Error: Could not locate sheet {self.sheet_name} in {str(self.path)}')
+
+    def get_shared_strings(self) -> list:
+        """Function to read the shared string table, which cells of type 's' refer to by index"""
+        shared_strings = []
+        if 'xl/sharedStrings.xml' not in self.zip.namelist():
+            return shared_strings
+        with self.zip.open('xl/sharedStrings.xml') as f:
+            for event, element in ET.iterparse(f, events=('end',)):
+                if element.tag == NS_MAIN + 'si':
+                    shared_strings.append(text_content(element))
+                    element.clear()
+        return shared_strings
+
+    def get_number_formats(self) -> list:
+        """Function to read the number format code of each cell style, which cells refer to by index.
+
+        Built-in formats are not listed in the workbook, so are returned as None.
+        """
+        number_formats = []
+        if 'xl/styles.xml' not in self.zip.namelist():
+            return number_formats
+        styles = ET.fromstring(self.zip.read('xl/styles.xml'))
+        format_codes = {}
+        for number_format in styles.iter(NS_MAIN + 'numFmt'):
+            format_codes[number_format.get('numFmtId')] = number_format.get('formatCode')
+        cell_styles = styles.find(NS_MAIN + 'cellXfs')
+        if cell_styles is not None:
+            for style in cell_styles.iter(NS_MAIN + 'xf'):
+                number_formats.append(format_codes.get(style.get('numFmtId', '0')))
+        return number_formats
+
+    def number_format(self, cell):
+        try:
+            return self.number_formats[int(cell.get('s', '0'))]
+        except (IndexError, ValueError):
+            return None
+
+    def cell_value(self, cell):
+        """Function to return the value of a cell as a Python str, int, float or bool.
+
+        Integers displayed with leading zeros, such as accession numbers, are returned as str as displayed.
+        """
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            element = cell.find(NS_MAIN + 'is')
+            return text_content(element) if element is not None else None
+        value = cell.findtext(NS_MAIN + 'v')
+        if value is None:
+            return None
+        if cell_type == 's':
+            return self.shared_strings[int(value)]
+        if cell_type == 'b':
+            return value == '1'
+        if cell_type in ['str', 'e']:
+            return value
+        try:
+            number = float(value)
+        except ValueError:
+            return value
+        if not number.is_integer():
+            return number
+        number_format = self.number_format(cell)
+        padding = RE_ZERO_PADDED_FORMAT.match(number_format) if number_format else None
+        if padding:
+            return str(int(number)).zfill(len(padding.group(1)))
+        return int(number)
+
+    def rows(self):
+        """Generator yielding one list of cell values per row of the sheet, beginning at first_column.
+
+        Empty rows are skipped; missing cells within a row are returned as None.
+        """
+        with self.zip.open(self.sheet_path) as f:
+            context = ET.iterparse(f, events=('start', 'end'))
+            sheet_data = None
+            row, index = {}, -1
+            for event, element in context:
+                if event == 'start':
+                    if element.tag == NS_MAIN + 'sheetData':
+                        sheet_data = element
+                    continue
+                if element.tag == NS_MAIN + 'c':
+                    column = RE_CELL_REFERENCE.sub(r'\1', element.get('r', ''))
+                    # Cells without a reference follow on from the previous cell
+                    index = column_index(column) if column else index + 1
+                    if index >= self.first_column:
+                        value = self.cell_value(element)
+                        if value is not None:
+                            row[index - self.first_column] = value
+                    element.clear()
+                elif element.tag == NS_MAIN + 'row':
+                    if row:
+                        yield [row.get(i) for i in range(max(row) + 1)]
+                    row, index = {}, -1
+                    # Discard processed rows, which are otherwise kept as children of sheetData,
+                    # so that memory use stays constant
+                    if sheet_data is not None:
+                        sheet_data.clear()
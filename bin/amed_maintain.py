@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# ====================
+#       Set-up
+# ====================
+
+# Import required modules
+from multiprocessing import freeze_support
+import time
+from amed_tools import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '3.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Functions
+# ====================
+
+
+def timed(message, function, *args):
+    """Function to run a function, reporting the time taken"""
+    date_time_message(message)
+    start = time.perf_counter()
+    result = function(*args)
+    log_print(f'\n{message} completed in {time.perf_counter() - start:.2f} seconds')
+    return result
+
+
+def report(message, values, level=logging.INFO):
+    """Function to report a number of problems found, logging each of them"""
+    log_print(f'{message}: {str(len(values))}')
+    for v in values:
+        logging.log(level, f'{message}: {str(v)}')
+
+
+# ====================
+#      Main code
+# ====================
+
+
+NAME = 'amed_maintain'
+SUMMARY = 'Check, de-duplicate, export and report statistics for the citation database'
+DATABASE_PATH = '\\Lookup files\\amed_citations.db'
+PARTITION_CITATIONS = 0
+
+
+def main(args=None):
+
+    amed = AMED(NAME, SUMMARY, ['c', 'check', 'stats', 'dedupe', 'repartition', 'export', 'workers'])
+    args = amed.parse_args(argv)
+    dbp, partition_years = DATABASE_PATH, PARTITION_CITATIONS
+
+    check_file_location(args.c[0], 'config file')
+    date_time_message(f'Reading config file from {str(args.c[0])}')
+    cfile = open(args.c[0], mode='r', encoding='utf-8', errors='replace')
+    for line in cfile:
+        if line.startswith('DATABASE_PATH'):
+            dbp = line.strip().split('=', 1)[1].strip()
+            check_file_location(dbp, 'DATABASE_PATH')
+        if line.startswith('PARTITION_CITATIONS'):
+            try:
+                partition_years = int(line.strip().split('=', 1)[1].strip())
+            except:
+                date_time_exit('Error: The value of the parameter PARTITION_CITATIONS must be an integer')
+    cfile.close()
+
+    check_partitions(dbp, partition_years)
+
+    # If no tasks are specified, run all tasks that do not change the database
+    if not (args.check or args.stats or args.dedupe or args.repartition or args.export):
+        args.check, args.stats, args.export = True, True, True
+
+    logging.info(f'DATABASE_PATH: {str(dbp)}\n'
+                 f'PARTITION_CITATIONS: {str(partition_years)}\n')
+
+    start = time.perf_counter()
+
+    # --------------------
+    # Read-only tasks
+    # --------------------
+
+    # These use read-only connections, so must finish before the database is opened for writing
+    if args.check:
+        problems = timed('Checking database integrity', check_databases, dbp, partition_years, args.workers)
+        for path in problems:
+            report(f'Integrity problems in {path}', problems[path], logging.ERROR)
+
+    results = timed('Scanning citations', scan_databases, dbp, partition_years, args.workers)
+
+    if args.check:
+        report('Empty citations', results['empty'], logging.WARNING)
+        report('Citation keys not normalised', results['not_normalised'], logging.WARNING)
+        if partition_years > 0:
+            report('Citations in the wrong partition', results['wrong_partition'], logging.WARNING)
+
+    if args.stats:
+        date_time_message('Statistics')
+        log_print(f'Number of citations: {str(results["count"])}')
+        log_print(f'Number of partitions: {str(len(partition_paths(dbp)) if partition_years > 0 else 0)}')
+        log_print('Number of citations by year of publication:')
+        for year in sorted(results['years']):
+            log_print(f'\t{year}\t{str(results["years"][year])}')
+
+    report('Groups of near-identical citation keys', results['near_duplicates'])
+
+    # --------------------
+    # Tasks which change the database
+    # --------------------
+
+    if args.dedupe or args.repartition or args.export:
+        db = open_citation_database(dbp, partition_years)
+        changed = False
+        if args.dedupe or (args.repartition and partition_years > 0):
+            # Near-identical keys have the same normalised form, so are merged when the keys are regenerated;
+            # citations in the wrong partition are moved at the same time
+            timed('Merging near-identical citation keys' if args.dedupe else
+                  'Moving citations into the correct partitions', db.rekey)
+            timed('Building indexes', db.build_index)
+            changed = True
+        if args.export and partition_years > 0:
+            timed('Exporting citations', db.export, db.partitions)
+        elif args.export or changed:
+            # Only partitions which have changed are exported
+            timed('Exporting citations', db.export)
+        db.close()
+
+    log_print(f'\nMaintenance completed in {time.perf_counter() - start:.2f} seconds')
+    date_time_exit()
+
+
+if __name__ == '__main__':
+    # Required for the worker processes used to scan the database when run as an executable
+    freeze_support()
+    main(argv[1:])
@@ -6,6 +6,7 @@
 # ====================
 
 # Import required modules
+from contextlib import ExitStack
 from amed_tools import *
 
 __author__ = 'Victoria Morris'
@@ -20,7 +21,10 @@ __status__ = '4 - Beta Development'
 
 class AmedRecord:
     def __init__(self, record):
-        self.record = record.split('\t')
+        # Records are either lines of tab-separated text exported from Excel,
+        # or lists of typed cell values read directly from the workbook
+        from_workbook = not isinstance(record, str)
+        self.record = list(record) if from_workbook else record.split('\t')
         logging.info(self.record)
         self.values = OrderedDict([
             ('AN', 0),  # Accession number
@@ -39,13 +43,17 @@ class AmedRecord:
         ])
         for v in self.values:
             try:
-                self.values[v] = clean(self.record[self.values[v]])
+                value = self.record[self.values[v]]
+                self.values[v] = clean('' if value is None else str(value))
             except:
-                self.values[v] = None
-            if self.values[v] == '"':
-                self.values[v] = None
-            if self.values[v] and self.values[v].startswith('"') and self.values[v].endswith('"'):
-                self.values[v] = self.values[v].strip('"')
+                # Empty cells at the end of a workbook row are not stored
+                self.values[v] = '' if from_workbook else None
+            if not from_workbook:
+                # Undo quoting added by Excel when saving as text
+                if self.values[v] == '"':
+                    self.values[v] = None
+                if self.values[v] and self.values[v].startswith('"') and self.values[v].endswith('"'):
+                    self.values[v] = self.values[v].strip('"')
             if v in ['ET', 'KW', 'MT', 'TY']:
                 self.values[v] = ', '.join(val for val in sorted(self.values[v].split(',')) if val)
         self.id = self.values['AN']
@@ -81,14 +89,14 @@ class AmedRecord:
 
 
 NAME = 'amed_post'
-SUMMARY = 'Process AMED files exported from Excel'
+SUMMARY = 'Process AMED files exported from Excel, or read directly from AMED processing.xlsm'
 
 
 def main(args=None):
     if args is None:
         name = str(argv[1])
 
-    amed = AMED(NAME, SUMMARY, ['i', 'c'])
+    amed = AMED(NAME, SUMMARY, ['i', 'c', 'gzip'])
     args = amed.parse_args(args)
 
     check_file_location(args.c[0], 'config file')
@@ -96,9 +104,13 @@ def main(args=None):
 
     today = datetime.date.today()
     month = today.month
+    dbp = None
 
     cfile = open(args.c[0], mode='r', encoding='utf-8', errors='replace')
     for line in cfile:
+        if line.startswith('DATABASE_PATH'):
+            dbp = line.strip().split('=', 1)[1].strip()
+            check_file_location(dbp, 'DATABASE_PATH')
         if line.startswith('MONTH'):
             month = line.strip().split('=', 1)[1].strip()
             try:
@@ -116,6 +128,7 @@ def main(args=None):
                 today = datetime.date(today.year, month, today.day)
     cfile.close()
 
+    logging.info(f'DATABASE_PATH: {str(dbp)}')
     logging.info(f'MONTH: {str(month)}')
     logging.info(f'Processing date: {str(today)}')
 
@@ -139,49 +152,73 @@ def main(args=None):
     log_print(f'Input file: {str(file)}')
 
     # Open input and output files
-    ifile = open(file, mode='r', encoding='utf-8', errors='replace')
-
-    first, last, count = None, '', 0
-    for f in output_files:
-        output_files[f] = open(output_files[f], mode='w', encoding='utf-8', errors='replace', newline='\r\n')
-
-    for f in ['hosts', 'spl', 'dat', 'txt']:
-        output_files[f].write('[STA]')
-
-    count = 0
-    for filelineno, line in enumerate(ifile):
-        if filelineno == 0:
-            continue
-        count += 1
-        print(f'{str(filelineno)} records processed', end='\r')
-        rec = AmedRecord(line.strip('\n'))
-        for f in ['hosts', 'dat']:
-            output_files[f].write(str(rec))
-        output_files['spl'].write(rec.no_wrap())
-        output_files['txt'].write(str(rec).replace('     AU:', '     UD: {:%Y%m}]\n     AU:'.format(today)))
+    # Every file is closed even if processing fails, or another file cannot be closed,
+    # so that the text already written is saved
+    with ExitStack() as files:
+        if is_workbook(file):
+            ifile = WorkbookReader(file)
+            files.callback(ifile.close)
+            records = ifile.rows()
+        else:
+            ifile = files.enter_context(open(file, mode='r', encoding='utf-8', errors='replace'))
+            records = (line.strip('\n') for line in ifile)
+
+        first, last, count = None, '', 0
         for f in output_files:
-            output_files[f].flush()
-        if not first:
-            first = rec.id
-        last = rec.id
-    for f in ['hosts', 'spl', 'dat', 'txt']:
-        output_files[f].write('\n[END]\n')
-    ifile.close()
-
-    output_files['end'].write('FILE f164{:%m%d}.dat'.format(today))
-
-    # Write statistics
-    output_files['stats'].write(f'Number of records processed: {str(count)}\n')
-    output_files['stats'].write(f'First record: {first}\n')
-    output_files['stats'].write(f'Last record: {last}\n')
-    output_files['stats'].write(f'Start next processing with accession number: {str(int(last) + 1)}\n')
-    output_files['stats'].write('\n\nText for email:\n\n' +
-                                'The {:%m/%Y} update for AMED is now on the FTP server. '.format(today) +
-                                f'There are {str(count)} records ({first} to {last})')
-
-    # Close files
-    for f in output_files:
-        output_files[f].close()
+            # The stats file is not part of the delivery, and the end marker must be readable before the data file
+            # is unpacked, so neither is ever compressed
+            output_files[f] = files.enter_context(BackgroundWriter(
+                DeliveryFile(output_files[f], compress=args.gzip and f not in ['stats', 'end'])))
+
+        for f in ['hosts', 'spl', 'dat', 'txt']:
+            output_files[f].write('[STA]')
+
+        count = 0
+        for filelineno, line in enumerate(records):
+            if filelineno == 0:
+                continue
+            count += 1
+            print(f'{str(filelineno)} records processed', end='\r')
+            rec = AmedRecord(line)
+            for f in ['hosts', 'dat']:
+                output_files[f].write(str(rec))
+            output_files['spl'].write(rec.no_wrap())
+            output_files['txt'].write(str(rec).replace('     AU:', '     UD: {:%Y%m}]\n     AU:'.format(today)))
+            if not first:
+                first = rec.id
+            last = rec.id
+        for f in ['hosts', 'spl', 'dat', 'txt']:
+            output_files[f].write('\n[END]\n')
+
+        # The end marker names the data file as delivered
+        output_files['end'].write('FILE f164{:%m%d}.dat{}'.format(today, '.gz' if args.gzip else ''))
+
+        # Close delivery files, so that their checksums are complete
+        for f in output_files:
+            if f != 'stats':
+                output_files[f].close()
+
+        # The next accession number is taken from the blocks reserved by amed_pre, where available,
+        # so that numbers given to records removed as duplicates are not used again
+        next_accession_number = None
+        if dbp and os.path.isfile(accession_path(dbp)):
+            next_accession_number = AccessionAllocator(dbp).next_accession_number()
+        if next_accession_number is None:
+            next_accession_number = int(last) + 1
+
+        # Write statistics
+        output_files['stats'].write(f'Number of records processed: {str(count)}\n')
+        output_files['stats'].write(f'First record: {first}\n')
+        output_files['stats'].write(f'Last record: {last}\n')
+        output_files['stats'].write(f'Start next processing with accession number: {str(next_accession_number)}\n')
+        output_files['stats'].write('\nSHA-256 checksums:\n')
+        for f in output_files:
+            if f != 'stats':
+                delivery_file = output_files[f].file
+                output_files['stats'].write(f'{delivery_file.sha256()}  {os.path.basename(delivery_file.path)}\n')
+        output_files['stats'].write('\n\nText for email:\n\n' +
+                                    'The {:%m/%Y} update for AMED is now on the FTP server. '.format(today) +
+                                    f'There are {str(count)} records ({first} to {last})')
 
     date_time_exit()
 
@@ -6,6 +6,7 @@
 # ====================
 
 # Import required modules
+from contextlib import ExitStack
 from amed_tools import *
 
 __author__ = 'Victoria Morris'
@@ -24,6 +25,16 @@ TITLES = {}
 NEW_JOURNALS = {}
 
 
+# ====================
+#      Functions
+# ====================
+
+
+def get_field(record, tag):
+    """Function to return the raw content of an ETOC field, or an empty string if the field is not present"""
+    return re.sub(r'^.*?<' + tag + r'>\s*(.*?)</' + tag + r'>.*?$', r'\1', record) if '<' + tag + '>' in record else ''
+
+
 # ====================
 #      Classes
 # ====================
@@ -50,8 +61,7 @@ class AMEDConverter:
                                      record.upper())
         if len(self.values['ISSN']) != 9:
             self.values['ISSN'] = None
-        self.values['Title'] = clean(
-            re.sub(r'^.*?<TEXT>\s*(.*?)</TEXT>.*?$', r'\1', record)) if '<TEXT>' in record else ''
+        self.values['Title'] = clean(get_field(record, 'TEXT'))
         if self.values['ISSN'] in ISSNS:
             journal_title = ISSNS[self.values['ISSN']]
         else:
@@ -72,13 +82,9 @@ class AMEDConverter:
                         NEW_JOURNALS[test] = abbreviation
                         TITLES[test] = abbreviation
                         break
-        issue = re.sub(r'\s*VOL\s*', '', re.sub(r'\s*VOL\s*([^\s]*?);\s*NUMBER\s*(.*)$', r'\1(\2)', clean(
-            re.sub(r'\s*\(S/\s*([0-9]+)\)', r'(Suppl \1)', re.sub(r'\s*SUPP/([0-9]+)', r'(Suppl \1)',
-                                                                  re.sub(r'^.*?<ISSUE>\s*(.*?)</ISSUE>.*?$', r'\1',
-                                                                         record)))))) if '<ISSUE>' in record else ''
-        pages = re.sub(r'^([^\-]+)-\1$', r'\1',
-                       clean(re.sub(r'^.*?<PAGE>\s*(.*?)</PAGE>.*?$', r'\1', record))) if '<PAGE>' in record else ''
-        self.values['Citation'] = journal_title + ' ' + issue + ':' + pages
+        issue = format_issue(get_field(record, 'ISSUE'))
+        pages = format_pages(get_field(record, 'PAGE'))
+        self.values['Citation'] = format_citation(journal_title, issue, pages)
         a_1 = re.sub(r'^.*?<AUTH>\s*(.*?)</AUTH>.*?$', r'\1', record) if '<AUTH>' in record else ''
         if a_1 != '':
             a_2 = []
@@ -90,8 +96,7 @@ class AMEDConverter:
         else:
             self.values['Authors'] = ''
 
-        self.values['Abstract'] = clean_html(
-            re.sub(r'^.*?<ABS>\s*(.*?)</ABS>.*?$', r'\1', record)) if '<ABS>' in record else ''
+        self.values['Abstract'] = clean_html(get_field(record, 'ABS'))
         self.values['Abstract indicator'] = 'AB' if self.values['Abstract'] != '' else None
 
     def __str__(self):
@@ -113,6 +118,7 @@ SUMMARY = 'Prepare AMED files for import to Excel'
 DATABASE_PATH = '\\Lookup files\\amed_citations.db'
 JOURNAL_ABBREVIATION_PATH = '\\Lookup files\\AMED journal title lookup table.txt'
 ACCESSION_NUMBER = 0
+PARTITION_CITATIONS = 0
 
 
 def main(args=None):
@@ -123,6 +129,7 @@ def main(args=None):
     amed = AMED(NAME, SUMMARY, ['i+', 'c'])
     args = amed.parse_args(argv)
     dbp, jap, accession_start = DATABASE_PATH, JOURNAL_ABBREVIATION_PATH, ACCESSION_NUMBER
+    partition_years = PARTITION_CITATIONS
 
     check_file_location(args.c[0], 'config file')
     date_time_message(f'Reading config file from {str(args.c[0])}')
@@ -135,16 +142,28 @@ def main(args=None):
             jap = line.strip().split('=', 1)[1].strip()
             check_file_location(jap, 'JOURNAL_ABBREVIATION_PATH')
         if line.startswith('ACCESSION_NUMBER'):
-            accession_start = line.strip().split('=', 1)[1].strip()
+            try:
+                accession_start = int(line.strip().split('=', 1)[1].strip())
+            except:
+                date_time_exit('Error: The value of the parameter ACCESSION_NUMBER must be an integer')
+        if line.startswith('PARTITION_CITATIONS'):
+            try:
+                partition_years = int(line.strip().split('=', 1)[1].strip())
+            except:
+                date_time_exit('Error: The value of the parameter PARTITION_CITATIONS must be an integer')
     cfile.close()
 
-    if not accession_start or not isinstance(accession_start, int) or accession_start == 0:
-        accession_start = get_accession_number()
-    accession_start = int(accession_start)
-
     logging.info(f'DATABASE_PATH: {str(dbp)}\n'
                  f'JOURNAL_ABBREVIATION_PATH: {str(jap)}\n'
-                 f'ACCESSION_NUMBER: {str(accession_start)}\n')
+                 f'ACCESSION_NUMBER: {str(accession_start)}\n'
+                 f'PARTITION_CITATIONS: {str(partition_years)}\n')
+
+    check_partitions(dbp, partition_years)
+
+    # Accession numbers follow on from those reserved by previous runs, unless ACCESSION_NUMBER is given
+    allocator = AccessionAllocator(dbp)
+    if not accession_start and allocator.next_accession_number() is None:
+        accession_start = get_accession_number()
 
     for a in args.i:
         file_list = glob.glob(a)
@@ -172,46 +191,73 @@ def main(args=None):
             jfile.close()
 
             # --------------------
-            # Read citations into memory:
+            # Open citation database:
             # --------------------
 
-            db = CitationDatabase(dbp)
-            citations_already_present = db.get_citations()
+            db = open_citation_database(dbp, partition_years)
+            if db.get_key_version() < KEY_VERSION:
+                # The rules for generating citation keys have changed since the database was last updated
+                db.rekey()
+                # The list of citations is exported again, even if no citations are added
+                db.build_index()
+                db.export()
+            citations_already_present = set()
             citations_to_add = list()
 
             # --------------------
             # Process input file
             # --------------------
 
-            # Open input and output files
-            ifile = open(file, mode='r', encoding='utf-8', errors='replace')
-
-            ofile = open('amed_as_tsv.tsv', mode='w', encoding='utf-8', errors='replace')
-            efile = open('amed_as_tsv_duplicates.tsv', mode='w', encoding='utf-8', errors='replace')
-            count = 0
-            accession_start -= 1
-
-            for filelineno, line in enumerate(ifile):
-                if line.strip() != '':
-                    count += 1
-                    print(f'{str(count)} records processed', end='\r')
-                    amed = AMEDConverter(clean(line.strip()), accession_start + count)
-                    citation = amed.values['Citation']
-                    # Append 20 characters from title
-                    citation += re.sub(r'[^A-Z0-9]', '', amed.values['Title'].upper())[:20]
-                    if citation and citation in citations_already_present:
-                        print('Citation {} is a duplicate'.format(str(citation)))
-                        efile.write(str(amed))
-                    else:
-                        citations_already_present.append(citation)
-                        citations_to_add.append((citation,))
-                        ofile.write(str(amed))
-
-            db.add_citations(citations_to_add)
+            # Reserve an accession number for each record before processing begins
+            with open(file, mode='r', encoding='utf-8', errors='replace') as ifile:
+                records = sum(1 for line in ifile if line.strip() != '')
+            accession_start = allocator.reserve_accession_numbers(records, accession_start or None)
+
+            count, inserting = 0, False
+            try:
+                # Open input and output files
+                # Every file is closed even if processing fails, or another file cannot be closed,
+                # so that the records already written are saved
+                with ExitStack() as files:
+                    ifile = files.enter_context(open(file, mode='r', encoding='utf-8', errors='replace'))
+                    ofile = files.enter_context(BackgroundWriter(
+                        open('amed_as_tsv.tsv', mode='w', encoding='utf-8', errors='replace')))
+                    efile = files.enter_context(BackgroundWriter(
+                        open('amed_as_tsv_duplicates.tsv', mode='w', encoding='utf-8', errors='replace')))
+                    for filelineno, line in enumerate(ifile):
+                        if line.strip() != '':
+                            amed = AMEDConverter(clean(line.strip()), accession_start + count)
+                            count += 1
+                            print(f'{str(count)} records processed', end='\r')
+                            citation = citation_key(amed.values['Citation'], amed.values['Title'])
+                            if citation and (citation in citations_already_present or db.has_citation(citation)):
+                                print('Citation {} is a duplicate'.format(str(citation)))
+                                efile.write(str(amed))
+                            else:
+                                citations_already_present.add(citation)
+                                citations_to_add.append((citation,))
+                                ofile.write(str(amed))
+
+                # Citations are only saved once the output files are complete
+                inserting = True
+                db.insert_citations(citations_to_add)
+            except:
+                if inserting:
+                    # Citations saved before the failure are removed; none of them were already present
+                    db.remove_citations(citations_to_add)
+                # Release the accession numbers reserved for this file, so that it can be processed again
+                allocator.record_accession_numbers(accession_start, 0)
+                raise
+
+            # Once the citations are saved the accession numbers are used, even if re-indexing or exporting fails
+            allocator.record_accession_numbers(accession_start, count)
+            if citations_to_add:
+                date_time_message('{} citations added'.format(str(len(citations_to_add))))
+                db.build_index()
+                db.export()
             db.close()
-
-            for f in [ofile, ifile, efile]:
-                f.close()
+            # Any further input files follow on from this one
+            accession_start = 0
 
             # --------------------
             # Save new journals
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+# ====================
+#       Set-up
+# ====================
+
+# Import required modules
+from amed_tools import *
+
+__author__ = 'Victoria Morris'
+__license__ = 'MIT License'
+__version__ = '3.0.0'
+__status__ = '4 - Beta Development'
+
+
+# ====================
+#      Main code
+# ====================
+
+
+NAME = 'amed_rekey'
+SUMMARY = 'Regenerate the citation keys in the citation database using the current rules'
+DATABASE_PATH = '\\Lookup files\\amed_citations.db'
+PARTITION_CITATIONS = 0
+
+
+def main(args=None):
+
+    amed = AMED(NAME, SUMMARY, ['c'])
+    args = amed.parse_args(argv)
+    dbp, partition_years = DATABASE_PATH, PARTITION_CITATIONS
+
+    check_file_location(args.c[0], 'config file')
+    date_time_message(f'Reading config file from {str(args.c[0])}')
+    cfile = open(args.c[0], mode='r', encoding='utf-8', errors='replace')
+    for line in cfile:
+        if line.startswith('DATABASE_PATH'):
+            dbp = line.strip().split('=', 1)[1].strip()
+            check_file_location(dbp, 'DATABASE_PATH')
+        if line.startswith('PARTITION_CITATIONS'):
+            try:
+                partition_years = int(line.strip().split('=', 1)[1].strip())
+            except:
+                date_time_exit('Error: The value of the parameter PARTITION_CITATIONS must be an integer')
+    cfile.close()
+
+    logging.info(f'DATABASE_PATH: {str(dbp)}\n'
+                 f'PARTITION_CITATIONS: {str(partition_years)}\n')
+
+    db = open_citation_database(dbp, partition_years)
+    log_print(f'Citation keys in database: version {str(db.get_key_version())}')
+    log_print(f'Current citation key rules: version {str(KEY_VERSION)}')
+    db.rekey()
+    db.export()
+    db.close()
+
+    date_time_exit()
+
+
+if __name__ == '__main__':
+    main(argv[1:])
@@ -2,6 +2,10 @@ python -m PyInstaller bin/amed_pre.py -F
 mv dist/amed_pre.exe exe/amed_pre.exe
 python -m PyInstaller bin/amed_post.py -F
 mv dist/amed_post.exe exe/amed_post.exe
+python -m PyInstaller bin/amed_rekey.py -F
+mv dist/amed_rekey.exe exe/amed_rekey.exe
+python -m PyInstaller bin/amed_maintain.py -F
+mv dist/amed_maintain.exe exe/amed_maintain.exe
 rm -rf amed_tools/__pycache__
 rm -rf build
 rm -rf dist
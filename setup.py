@@ -21,6 +21,8 @@ setup(
     console=[
         'bin/amed_pre.py',
         'bin/amed_post.py',
+        'bin/amed_rekey.py',
+        'bin/amed_maintain.py',
     ],
     zipfile=None,
     options={
@@ -39,6 +41,8 @@ setup(
     scripts=[
         'bin/amed_pre.py',
         'bin/amed_post.py',
+        'bin/amed_rekey.py',
+        'bin/amed_maintain.py',
     ],
     classifiers=[
         'Development Status :: 4 - Beta',